@@ -1,15 +1,29 @@
 
 import os
+import time
+import queue
 import asyncio
-from typing import Dict
-from contextlib import asynccontextmanager
-from fastapi import FastAPI
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Tuple
+import numpy as np
+from contextlib import AsyncExitStack, asynccontextmanager, suppress
+import aiohttp
+import httpx
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from dotenv import load_dotenv
+from openai import AsyncAzureOpenAI
+from azure.core.pipeline.transport import AioHttpTransport
 from azure.identity.aio import DefaultAzureCredential
+from redis.asyncio import Redis
+from redis.exceptions import LockError
 from semantic_kernel.functions import kernel_function
 from semantic_kernel.agents import (AzureAIAgent,ConcurrentOrchestration,ChatCompletionAgent,ChatHistoryAgentThread,)
 from semantic_kernel.agents.runtime import InProcessRuntime
-from semantic_kernel.connectors.ai.open_ai import AzureChatCompletion
+from semantic_kernel.connectors.ai.open_ai import AzureChatCompletion, AzureTextEmbedding
+from semantic_kernel.contents import AuthorRole, ChatHistory, ChatMessageContent
 from pydantic import BaseModel
 from fastapi import Body
 
@@ -21,6 +35,58 @@ DATA_AGENT_ID        = "asst_tjBNSa3vhqralopDSHeXItHl"
 AZ_OPENAI_ENDPOINT   = os.environ["AZURE_OPENAI_ENDPOINT"]
 AZ_OPENAI_DEPLOYMENT = os.environ["AZURE_OPENAI_DEPLOYMENT"]
 AZ_OPENAI_API_KEY    = os.environ["AZURE_OPENAI_API_KEY"]
+AZ_OPENAI_API_VERSION = os.environ.get("AZURE_OPENAI_API_VERSION", "2024-10-21")
+# Semantic response cache; disabled unless an embedding deployment is set
+AZ_OPENAI_EMBEDDING_DEPLOYMENT = os.environ.get("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
+SEMANTIC_CACHE_THRESHOLD       = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+SEMANTIC_CACHE_MAX_ENTRIES     = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", "32"))
+SEMANTIC_CACHE_MAX_CONVERSATIONS = int(os.environ.get("SEMANTIC_CACHE_MAX_CONVERSATIONS", "1024"))
+MAX_THREADS          = int(os.environ.get("MAX_THREADS", "1024"))
+# Shared thread store for multi-worker deployments; in-process LRU if unset
+REDIS_URL            = os.environ.get("REDIS_URL")
+THREAD_TTL           = int(os.environ.get("THREAD_TTL", "3600"))
+# Expiry of the cross-worker conversation lock; must outlast one turn
+THREAD_LOCK_TIMEOUT  = int(os.environ.get("THREAD_LOCK_TIMEOUT", "300"))
+# Scope the agent client authenticates with; refreshed ahead of expiry
+AZURE_TOKEN_SCOPE    = os.environ.get("AZURE_TOKEN_SCOPE", "https://management.azure.com/.default")
+TOKEN_REFRESH_MARGIN = 300
+ANALYSE_TIMEOUT      = float(os.environ.get("ANALYSE_TIMEOUT", "50"))
+# Seconds to wait on the primary orchestration before firing a hedge;
+# unset (the default) disables hedging
+ANALYSE_HEDGE_DELAY  = float(os.environ["ANALYSE_HEDGE_DELAY"]) if os.environ.get("ANALYSE_HEDGE_DELAY") else None
+# Upper bound on batch entries in flight against Azure at once
+BATCH_CONCURRENCY    = int(os.environ.get("BATCH_CONCURRENCY", "16"))
+BATCH_MAX_SIZE       = int(os.environ.get("BATCH_MAX_SIZE", "64"))
+
+# Kept byte-identical across requests: no timestamps, ids or other
+# per-request data may be added here, so Azure OpenAI's automatic prompt
+# caching can reuse the prefix on every turn.
+HOST_INSTRUCTIONS = (
+    "You are the Host responsible for consolidating and presenting information from multiple agents.\n\n"
+    "- If the user message is ONLY a friendly greeting or general inquiry (e.g., \"Hello\", \"How are you?\"), reply with a brief, polite greeting.\n"
+    "- For any other query:\n"
+    "  1. ALWAYS call the tool **analyse_task** with the full user message.\n"
+    "  2. Receive and process the individual agent responses.\n"
+    "  3. Combine and format the outputs clearly, preserving all relevant details without omission.\n"
+    "  4. Return the consolidated response VERBATIM, ensuring:\n"
+    "     - Formatting (headings, lists, tables) is preserved.\n"
+    "     - Notes, warnings, and key points are clearly visible.\n"
+    "     - No markdown is used if it's incompatible with Microsoft Teams (use plain text with indentation where needed).\n"
+    "     - Responses are easy to read and follow logically.\n\n"
+    "Your role is NOT to summarize or interpret — only to present the complete, accurate output from the agents as intended for end-user viewing in Microsoft Teams."
+)
+
+# Handlers only enqueue records; a background listener does the blocking
+# stdout writes, keeping log I/O off the request path. Only the app's own
+# logger is routed here; root and third-party loggers keep their defaults.
+log_queue: queue.Queue = queue.Queue(-1)
+logger = logging.getLogger("rcacapa")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").strip().upper()
+if not isinstance(logging.getLevelName(LOG_LEVEL), int):
+    raise ValueError(f"LOG_LEVEL must be one of DEBUG, INFO, WARNING, ERROR, CRITICAL; got {LOG_LEVEL!r}")
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(QueueHandler(log_queue))
+logger.propagate = False
 
 class ChatRequest(BaseModel):
     user_query: str
@@ -28,116 +94,393 @@ class ChatRequest(BaseModel):
 
 
 #global singletons
+http_session: aiohttp.ClientSession | None = None
+redis_client: Redis | None = None
+aoai_client: AsyncAzureOpenAI | None = None
+host_agent: ChatCompletionAgent | None = None
+embedding_service: AzureTextEmbedding | None = None
 credential: DefaultAzureCredential | None = None
 agent_client: object | None = None
 orchestration: ConcurrentOrchestration | None = None
 runtime: InProcessRuntime | None = None
 
+async def refresh_token_loop():
+    """Keep the credential's token cache warm so no request waits on a refresh."""
+    while True:
+        try:
+            token = await credential.get_token(AZURE_TOKEN_SCOPE)
+            delay = max(token.expires_on - time.time() - TOKEN_REFRESH_MARGIN, 60)
+        except Exception as exc:
+            logger.warning("token refresh failed: %s", exc)
+            delay = 60
+        await asyncio.sleep(delay)
+
+async def stop_task(task: asyncio.Task) -> None:
+    """Cancel task and wait for it, so nothing it awaits outlives shutdown."""
+    task.cancel()
+    with suppress(asyncio.CancelledError):
+        await task
+
 # FastAPI with lifespan
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     
+    global http_session, redis_client, aoai_client, host_agent, embedding_service
     global credential, agent_client, orchestration, runtime
-    credential = DefaultAzureCredential()
-    
-    # Create client using async context manager pattern
-    client = AzureAIAgent.create_client(
-        credential=credential,
-        conn_str=PROJECT_CONN_STR,
-    )
-    
-    # Store the client for later use
-    agent_client = client
-    
-    # Get agent definitions
-    cat_def = await client.agents.get_agent(CATEGORISER_AGENT_ID)
-    data_def = await client.agents.get_agent(DATA_AGENT_ID)
-    
-    # Create agents and orchestration
-    members = [
-        AzureAIAgent(client=client, definition=cat_def),
-        AzureAIAgent(client=client, definition=data_def),
-    ]
-    orchestration = ConcurrentOrchestration(members)
-    
-    # Initialize and start runtime
-    runtime = InProcessRuntime()
-    runtime.start()
-    
-    print("warm-up complete; server ready")
-    yield
-    
-    # Cleanup
-    await runtime.stop_when_idle()
-    
-    # Close client if it has a close method
-    if hasattr(client, 'close'):
-        await client.close()
-    
-    # Close credential
-    await credential.close()
-    print("resources closed")
+    # Every resource is registered as soon as it exists, so a failure part-way
+    # through startup still releases whatever was opened before it
+    async with AsyncExitStack() as stack:
+        log_listener = QueueListener(log_queue, logging.StreamHandler())
+        log_listener.start()
+        stack.callback(log_listener.stop)
+        stack.callback(logger.info, "resources closed")
+        
+        credential = DefaultAzureCredential()
+        stack.push_async_callback(credential.close)
+        if REDIS_URL:
+            redis_client = Redis.from_url(REDIS_URL)
+            stack.push_async_callback(redis_client.aclose)
+        
+        # One pooled keep-alive session shared by every Azure call, so warm
+        # requests skip the TCP+TLS handshake
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=60)
+        )
+        stack.push_async_callback(http_session.close)
+        transport = AioHttpTransport(session=http_session, session_owner=False)
+        
+        # Likewise one httpx pool behind every Azure OpenAI call (chat + embeddings)
+        aoai_client = AsyncAzureOpenAI(
+            azure_endpoint=AZ_OPENAI_ENDPOINT,
+            api_key=AZ_OPENAI_API_KEY,
+            api_version=AZ_OPENAI_API_VERSION,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+            ),
+        )
+        stack.push_async_callback(aoai_client.close)
+        host_agent = ChatCompletionAgent(
+            service=AzureChatCompletion(
+                deployment_name=AZ_OPENAI_DEPLOYMENT,
+                endpoint=AZ_OPENAI_ENDPOINT,
+                async_client=aoai_client,
+            ),
+            name="Host",
+            instructions=HOST_INSTRUCTIONS,
+            plugins=[agentplugin]
+        )
+        if AZ_OPENAI_EMBEDDING_DEPLOYMENT:
+            embedding_service = AzureTextEmbedding(
+                deployment_name=AZ_OPENAI_EMBEDDING_DEPLOYMENT,
+                endpoint=AZ_OPENAI_ENDPOINT,
+                async_client=aoai_client,
+            )
+        
+        # Create client using async context manager pattern
+        client = AzureAIAgent.create_client(
+            credential=credential,
+            conn_str=PROJECT_CONN_STR,
+            transport=transport,
+        )
+        stack.push_async_callback(client.close)
+        
+        # Store the client for later use
+        agent_client = client
+        
+        # Get agent definitions (independent lookups, fetched concurrently)
+        cat_def, data_def = await asyncio.gather(
+            client.agents.get_agent(CATEGORISER_AGENT_ID),
+            client.agents.get_agent(DATA_AGENT_ID),
+        )
+        
+        # Create agents and orchestration
+        members = [
+            AzureAIAgent(client=client, definition=cat_def),
+            AzureAIAgent(client=client, definition=data_def),
+        ]
+        orchestration = ConcurrentOrchestration(members)
+        
+        # Initialize and start runtime
+        runtime = InProcessRuntime()
+        runtime.start()
+        stack.push_async_callback(runtime.stop_when_idle)
+        
+        token_refresher = asyncio.create_task(refresh_token_loop())
+        stack.push_async_callback(stop_task, token_refresher)
+        
+        logger.info("warm-up complete; server ready")
+        yield
 
 # Plugins
 class IndegeneCompliancePlugin:
     @kernel_function(name="analyse_task",
                      description="Run categoriser + data agents concurrently")
     async def analyse_task(self, task: str) -> str:
-        fut     = await orchestration.invoke(task=task, runtime=runtime)
-        answers = await fut.get(timeout=50)
-        return "\n\n".join(f"{a.name}:\n{a.items[0].text}" for a in answers)
+        answers = await self._hedged_invoke(task)
+        parts   = [f"{a.name}:\n{a.items[0].text}" for a in answers]
+        return "\n\n".join(parts)
+
+    async def _hedged_invoke(self, task: str):
+        """Run the orchestration, racing a second copy if the first is slow."""
+        # fut.get() task -> the OrchestrationResult it waits on
+        attempts = {}
+
+        async def start():
+            result = await orchestration.invoke(task=task, runtime=runtime)
+            attempts[asyncio.create_task(result.get(timeout=ANALYSE_TIMEOUT))] = result
+
+        winner = None
+        try:
+            await start()
+            if ANALYSE_HEDGE_DELAY is not None:
+                done, _ = await asyncio.wait(attempts, timeout=ANALYSE_HEDGE_DELAY)
+                if not done:
+                    await start()
+
+            pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if t.exception() is None:
+                        winner = t
+                        return t.result()
+            # Every attempt failed; surface the primary's error
+            return next(iter(attempts)).result()
+        finally:
+            # Stop the losing runs in the runtime, not just our wait on them
+            for t, result in attempts.items():
+                if t is winner:
+                    continue
+                t.cancel()
+                try:
+                    result.cancel()
+                except RuntimeError:
+                    pass  # already completed or cancelled
 
 agentplugin = IndegeneCompliancePlugin()
-host_agent  = ChatCompletionAgent(
-    service=AzureChatCompletion(
-        deployment_name=AZ_OPENAI_DEPLOYMENT,
-        endpoint=AZ_OPENAI_ENDPOINT,
-        api_key=AZ_OPENAI_API_KEY,
-    ),
-    name="Host",
-    instructions=(
-        "You are the Host responsible for consolidating and presenting information from multiple agents.\n\n"
-        "- If the user message is ONLY a friendly greeting or general inquiry (e.g., \"Hello\", \"How are you?\"), reply with a brief, polite greeting.\n"
-        "- For any other query:\n"
-        "  1. ALWAYS call the tool **analyse_task** with the full user message.\n"
-        "  2. Receive and process the individual agent responses.\n"
-        "  3. Combine and format the outputs clearly, preserving all relevant details without omission.\n"
-        "  4. Return the consolidated response VERBATIM, ensuring:\n"
-        "     - Formatting (headings, lists, tables) is preserved.\n"
-        "     - Notes, warnings, and key points are clearly visible.\n"
-        "     - No markdown is used if it's incompatible with Microsoft Teams (use plain text with indentation where needed).\n"
-        "     - Responses are easy to read and follow logically.\n\n"
-        "Your role is NOT to summarize or interpret — only to present the complete, accurate output from the agents as intended for end-user viewing in Microsoft Teams."
-    ),
-    plugins=[agentplugin]
-)
 
-threads: Dict[str, ChatHistoryAgentThread] = {}
+# LRU of conversation_id -> most recent (normalised query embedding, response)
+# pairs, bounded on its own so it holds in Redis mode too
+response_cache: "OrderedDict[str, Deque[Tuple[np.ndarray, str]]]" = OrderedDict()
+
+async def embed(text: str) -> np.ndarray:
+    """Return the unit-length embedding of text."""
+    vec = (await embedding_service.generate_embeddings([text]))[0]
+    return vec / np.linalg.norm(vec)
+
+async def try_embed(text: str) -> np.ndarray | None:
+    """Embed text for the cache; None if the cache is off or embedding fails."""
+    if embedding_service is None:
+        return None
+    try:
+        return await embed(text)
+    except Exception:
+        # The cache is an optimisation only; never fail the turn over it
+        logger.warning("semantic cache embedding failed; continuing uncached", exc_info=True)
+        return None
+
+def lookup_cached(cid: str, emb: np.ndarray) -> str | None:
+    """Return the stored response of the most similar prior query, if close enough."""
+    entries = response_cache.get(cid)
+    if not entries:
+        return None
+    response_cache.move_to_end(cid)
+    sims = np.stack([e for e, _ in entries]) @ emb
+    best = int(np.argmax(sims))
+    return entries[best][1] if sims[best] >= SEMANTIC_CACHE_THRESHOLD else None
+
+def store_cached(cid: str, emb: np.ndarray, response: str) -> None:
+    entries = response_cache.get(cid)
+    if entries is None:
+        entries = response_cache[cid] = deque(maxlen=SEMANTIC_CACHE_MAX_ENTRIES)
+        if len(response_cache) > SEMANTIC_CACHE_MAX_CONVERSATIONS:
+            response_cache.popitem(last=False)
+    else:
+        response_cache.move_to_end(cid)
+    entries.append((emb, response))
+
+async def record_cached_turn(thread: ChatHistoryAgentThread, user_query: str, response: str) -> None:
+    """Append a cache-served exchange so later turns still see it in the history."""
+    await thread.on_new_message(ChatMessageContent(role=AuthorRole.USER, content=user_query))
+    await thread.on_new_message(ChatMessageContent(role=AuthorRole.ASSISTANT, content=response))
+
+# LRU of live conversations, capped at MAX_THREADS
+threads: "OrderedDict[str, ChatHistoryAgentThread]" = OrderedDict()
+# conversation_id -> [lock, number of requests holding or waiting on it]
+thread_locks: Dict[str, list] = {}
 
 def get_thread(cid: str) -> ChatHistoryAgentThread:
     """Return existing thread or create a new one for this conversation_id."""
-    if cid not in threads:
-        threads[cid] = ChatHistoryAgentThread()
-    return threads[cid]
+    try:
+        thread = threads[cid]
+    except KeyError:
+        thread = threads[cid] = ChatHistoryAgentThread()
+        if len(threads) > MAX_THREADS:
+            threads.popitem(last=False)
+    else:
+        threads.move_to_end(cid)
+    return thread
+
+async def load_thread(cid: str) -> ChatHistoryAgentThread:
+    """Return the thread for this conversation_id, restoring it from Redis if configured."""
+    if redis_client is None:
+        return get_thread(cid)
+    blob = await redis_client.get(f"rcacapa:thread:{cid}")
+    history = ChatHistory.restore_chat_history(blob.decode()) if blob else None
+    return ChatHistoryAgentThread(chat_history=history)
+
+async def save_thread(cid: str, thread: ChatHistoryAgentThread) -> None:
+    """Write the thread's history back to Redis with a sliding TTL."""
+    if redis_client is None:
+        return
+    history = ChatHistory(messages=[m async for m in thread.get_messages()])
+    await redis_client.set(f"rcacapa:thread:{cid}", history.serialize(), ex=THREAD_TTL)
+
+@asynccontextmanager
+async def conversation_lock(cid: str):
+    """Serialise concurrent turns on the same conversation_id, across workers with Redis."""
+    entry = thread_locks.get(cid)
+    if entry is None:
+        entry = thread_locks[cid] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            if redis_client is None:
+                yield
+            else:
+                # Other workers share the Redis history; without this the last
+                # save_thread would win and silently drop a concurrent turn
+                lock = redis_client.lock(f"rcacapa:lock:{cid}", timeout=THREAD_LOCK_TIMEOUT)
+                await lock.acquire()
+                try:
+                    yield
+                finally:
+                    try:
+                        await lock.release()
+                    except LockError:
+                        # Expired mid-turn; the turn itself already completed
+                        logger.warning("conversation lock for %s expired before release", cid)
+    finally:
+        # Drop the lock once nobody holds or awaits it, so it can't go stale
+        entry[1] -= 1
+        if entry[1] == 0:
+            del thread_locks[cid]
+
+# Binds to the worker's loop on first use, so it is safe to create pre-fork
+batch_semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
 
 # Initialize FastAPI with our lifespan context manager
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+@asynccontextmanager
+async def conversation_turn(req: ChatRequest):
+    """Hold the conversation for one turn and yield (emb, thread, cached).
+
+    A cache hit is recorded in the thread here; otherwise the caller runs
+    the Host on the thread, which is saved when the block exits cleanly.
+    """
+    async with conversation_lock(req.conversation_id):
+        emb = await try_embed(req.user_query)
+        thread = await load_thread(req.conversation_id)
+
+        cached = lookup_cached(req.conversation_id, emb) if emb is not None else None
+        if cached is not None:
+            await record_cached_turn(thread, req.user_query, cached)
+        yield emb, thread, cached
+        await save_thread(req.conversation_id, thread)
 
 @app.post("/rcacapa-query")
+async def chat_stream(req: ChatRequest = Body(...)):
+    """Stream the Host reply as plain text, token by token."""
+    async def gen():
+        # Each chunk is held back until the next arrives, so the turn is saved
+        # and the conversation lock released before the last one goes out
+        chunks = []
+        async with conversation_turn(req) as (emb, thread, cached):
+            if cached is None:
+                async for chunk in host_agent.invoke_stream(
+                    messages=req.user_query,
+                    thread=thread,
+                ):
+                    text = chunk.message.content
+                    if text:
+                        if chunks:
+                            yield chunks[-1]
+                        chunks.append(text)
+
+        if cached is not None:
+            yield cached
+            return
+        if emb is not None:
+            store_cached(req.conversation_id, emb, "".join(chunks))
+        if chunks:
+            yield chunks[-1]
+
+    return StreamingResponse(gen(), media_type="text/plain")
+
+async def answer(req: ChatRequest) -> str:
+    """Run one turn through the Host and return its reply as plain text."""
+    async with conversation_turn(req) as (emb, thread, cached):
+        if cached is not None:
+            return cached
+
+        assistant_msg = await host_agent.get_response(
+            messages=req.user_query,
+            thread=thread,
+        )
+
+    # Joined exactly as the stream emits it, so both paths cache one form
+    texts = [item.text for item in assistant_msg.items if getattr(item, "text", None)]
+    plain_response = "".join(texts)
+    if emb is not None:
+        store_cached(req.conversation_id, emb, plain_response)
+    return plain_response
+
+@app.post("/rcacapa-query/full")
 async def chat(req: ChatRequest = Body(...)):
-    thread = get_thread(req.conversation_id)
+    """Return the whole Host reply as a single JSON object."""
+    return {"assistant": await answer(req)}
 
-    assistant_msg = await host_agent.get_response(
-        messages=req.user_query,
-        thread=thread,
-    )
+@app.post("/rcacapa-query/batch")
+async def chat_batch(reqs: List[ChatRequest] = Body(...)):
+    """Answer many turns concurrently; results keep the request order.
 
-    plain_response = " ".join(
-        item.text for item in assistant_msg.items
-        if getattr(item, "text", None)
-    )
-    return {"assistant": plain_response}
+    Entries sharing a conversation_id run one after another in request
+    order; a failed entry yields {"error": "internal_error", ...} without
+    affecting others.
+    """
+    if len(reqs) > BATCH_MAX_SIZE:
+        raise HTTPException(status_code=413, detail=f"batch exceeds {BATCH_MAX_SIZE} entries")
+
+    results: List[Dict[str, str] | None] = [None] * len(reqs)
+    by_conversation: Dict[str, List[int]] = {}
+    for i, r in enumerate(reqs):
+        by_conversation.setdefault(r.conversation_id, []).append(i)
+
+    async def run_conversation(indices: List[int]) -> None:
+        for i in indices:
+            async with batch_semaphore:
+                try:
+                    results[i] = {"assistant": await answer(reqs[i])}
+                except Exception:
+                    # Details stay in the log; they may carry Azure bodies or endpoints
+                    logger.exception("batch entry %d failed", i)
+                    results[i] = {"error": "internal_error", "message": "This entry could not be answered."}
+
+    await asyncio.gather(*[run_conversation(ix) for ix in by_conversation.values()])
+    return results
 
 @app.get("/health")
 async def health_check():
-    return {"status": "ok", "message": "Indegene Compliance Agent is running."}
\ No newline at end of file
+    return {"status": "ok", "message": "Indegene Compliance Agent is running."}
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", "8000")),
+        loop="auto",
+        http="auto",
+    )
@@ -0,0 +1,22 @@
+# gunicorn -c gunicorn_conf.py app:app
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind         = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+# Without Redis, conversation threads live inside one worker, so a second
+# worker would serve follow-up turns without their history
+_default_workers = (os.cpu_count() or 1) if os.environ.get("REDIS_URL") else 1
+workers      = int(os.environ.get("WEB_CONCURRENCY", _default_workers))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+if workers > 1 and not os.environ.get("REDIS_URL"):
+    raise RuntimeError("workers > 1 requires REDIS_URL so conversation history is shared across workers")
+
+# Import app.py once in the master and fork it into the workers. Anything
+# holding a socket, event loop or thread (Azure/OpenAI/Redis clients, the
+# orchestration runtime, the log listener) is created in the FastAPI
+# lifespan, which runs in each worker after the fork.
+preload_app  = True